@@ -5,31 +5,107 @@ import email.policy as email_policy
 import json
 import os
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 from tkinter import ttk
 from tkinter.scrolledtext import ScrolledText
 
+try:
+    # faster JSON encoding & parsing, if it's installed
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf8')
+    _json_loads = json.loads
+
+
+FOLDERS_SYNC_INTERVAL = 60 # seconds - don't check the server for folder changes more often than this
+# seconds to wait for the server to connect or send more data - worker threads are joined when the program exits,
+# so a stalled request would otherwise keep it running after the window is closed
+REQUEST_TIMEOUT = 30
+
 
 # https://jmap.io/spec-core.html
 # https://jmap.io/client.html
 
+# static parts of the get_emails() method calls - the nested values are shared, so don't modify them
+_EMAIL_QUERY_ARGS = {
+    "sort": [{"property": "receivedAt", "isAscending": False }],
+    "collapseThreads": False, "position": 0, "limit": 20
+}
+_EMAIL_GET_ARGS = {
+    "#ids": {
+        "name": "Email/query",
+        "path": "/ids",
+        "resultOf": "0"
+    },
+    "properties": ['subject', 'from', 'sentAt', 'blobId']
+}
+
+
+class SessionExpired(Exception):
+    # the server rejected the saved session info - refresh it (see refresh_session()) and retry
+    pass
+
 
 class EmailServer:
 
-    def __init__(self):
+    def __init__(self, storage=None):
+        import requests # only needed (and installed) when talking to a server, not for the GUI/storage tests
+
+        self._storage = storage
         self._token = os.environ['TOKEN']
         self._authorization = f'Bearer {self._token}'
-        self._headers = {'Authorization': self._authorization, 'Content-type': 'application/json'}
-        self._account_id = None
-        self._api_url = None
-        self._download_url = None
-
-    def _init_session(self):
-        session_response = requests.get(os.environ['SESSION_URL'], headers=self._headers)
-        session_info = session_response.json()
-        self._account_id = session_info['primaryAccounts']['urn:ietf:params:jmap:mail']
-        self._api_url = session_info['apiUrl']
-        self._download_url = session_info['downloadUrl']
+        # one HTTP session for all requests, so connections are kept alive & reused
+        self._session = requests.Session()
+        self._session.headers.update({'Authorization': self._authorization})
+        self._session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=20))
+        self._session_info_cached = False
+        self.account_id = None
+        self.api_url = None
+        self.download_url = None # eg. https://localhost/jmap/download/{accountId}/{blobId}/{name}?type={type}
+        self._init_session()
+
+    def close(self):
+        self._session.close()
+
+    def _init_session(self, use_cache=True):
+        # the session info rarely changes, so reuse what we saved last time if we can
+        if use_cache and self._storage:
+            session_info = self._storage.get_session_info()
+            if session_info:
+                self.account_id = session_info['account_id']
+                self.api_url = session_info['api_url']
+                self.download_url = session_info['download_url']
+                self._session_info_cached = True
+                return
+        self.set_session_info(self.fetch_session_info())
+
+    def fetch_session_info(self):
+        # only reads from the server, so it can run on a worker thread
+        session_response = self._session.get(os.environ['SESSION_URL'], timeout=REQUEST_TIMEOUT)
+        session_info = _json_loads(session_response.content)
+        return {
+            'account_id': session_info['primaryAccounts']['urn:ietf:params:jmap:mail'],
+            'api_url': session_info['apiUrl'],
+            'download_url': session_info['downloadUrl'],
+        }
+
+    def set_session_info(self, session_info):
+        # only call this from the Tk thread - it writes to storage, which can only be used from the thread that opened it
+        self.account_id = session_info['account_id']
+        self.api_url = session_info['api_url']
+        self.download_url = session_info['download_url']
+        self._session_info_cached = False
+        if self._storage:
+            self._storage.save_session_info(session_info)
+
+    def refresh_session(self):
+        # blocks until the server answers - the GUI uses refresh_session_in_background() instead
+        self.set_session_info(self.fetch_session_info())
 
     def _post_request(self, method_calls):
         request = {
@@ -39,37 +115,23 @@ class EmailServer:
             ],
             'methodCalls': method_calls,
         }
-        r = requests.post(self.api_url, data=json.dumps(request), headers=self._headers)
-        if r.ok:
+        session_info_cached = self._session_info_cached
+        r = self._session.post(self.api_url, data=_json_dumps(request), headers={'Content-type': 'application/json'},
+                               timeout=REQUEST_TIMEOUT)
+        if r.status_code == 401 and session_info_cached:
+            # saved session info may be stale - this can run on a worker thread, so leave the refresh to the caller
+            raise SessionExpired()
+        if 200 <= r.status_code < 300: # cheaper than r.ok, which calls raise_for_status()
             return r
         else:
             raise Exception(f'server error: {r.status_code} -- {r.content.decode("utf8")}')
 
-    @property
-    def account_id(self):
-        if not self._account_id:
-            self._init_session()
-        return self._account_id
-
-    @property
-    def api_url(self):
-        if not self._api_url:
-            self._init_session()
-        return self._api_url
-
-    @property
-    def download_url(self):
-        # eg. https://localhost/jmap/download/{accountId}/{blobId}/{name}?type={type}
-        if not self._download_url:
-            self._init_session()
-        return self._download_url
-
     def get_folders(self):
         method_calls = [
             [ 'Mailbox/get', {'accountId': self.account_id, 'ids': None}, '0' ],
         ]
         r = self._post_request(method_calls)
-        folders_info = r.json()
+        folders_info = _json_loads(r.content)
         method_responses = folders_info['methodResponses']
         mailbox_get_info = method_responses[0][1]
         state = mailbox_get_info['state']
@@ -79,85 +141,108 @@ class EmailServer:
     def get_folder_changes(self, state):
         method_calls = [
             ['Mailbox/changes', {'accountId': self.account_id, 'sinceState': state}, '0'],
-            ['Mailbox/get',
-             {'accountId': self.account_id, '#ids': { 'resultOf': '0', 'name': 'Mailbox/changes', 'path': '/created' }},
-             '1'],
-            ['Mailbox/get',
-             {'accountId': self.account_id, '#ids': { 'resultOf': '0', 'name': 'Mailbox/changes', 'path': '/updated' }},
-             '2'],
         ]
         r = self._post_request(method_calls)
-        method_responses = r.json()['methodResponses']
-        mailbox_changes_info = method_responses[0][1]
+        mailbox_changes_info = _json_loads(r.content)['methodResponses'][0][1]
         new_state = mailbox_changes_info['newState']
         changes = {
             'created': [],
             'deleted': [{'id': id} for id in mailbox_changes_info['destroyed']],
             'updated': [],
         }
-        if mailbox_changes_info['created']:
-            changes['created'] = [{'id': m['id'], 'name': m['name'], 'role': m['role'], 'parent_id': m['parentId'], 'sort_order': m['sortOrder']}
-                                  for m in method_responses[1][1]['list']]
+        # only fetch folder details if there's something to fetch - usually nothing has changed
+        created_ids = mailbox_changes_info['created']
         # don't worry about counts at this point - only update folders that have had properties updated
-        if mailbox_changes_info['updated'] and not mailbox_changes_info['updatedProperties']:
+        updated_ids = [] if mailbox_changes_info['updatedProperties'] else mailbox_changes_info['updated']
+        if created_ids or updated_ids:
+            method_calls = [
+                ['Mailbox/get', {'accountId': self.account_id, 'ids': created_ids}, '0'],
+                ['Mailbox/get', {'accountId': self.account_id, 'ids': updated_ids}, '1'],
+            ]
+            r = self._post_request(method_calls)
+            method_responses = _json_loads(r.content)['methodResponses']
+            changes['created'] = [{'id': m['id'], 'name': m['name'], 'role': m['role'], 'parent_id': m['parentId'], 'sort_order': m['sortOrder']}
+                                  for m in method_responses[0][1]['list']]
             changes['updated'] = [{'id': m['id'], 'name': m['name'], 'role': m['role'], 'parent_id': m['parentId'], 'sort_order': m['sortOrder']}
-                                  for m in method_responses[2][1]['list']]
+                                  for m in method_responses[1][1]['list']]
         return new_state, changes
 
     def get_emails(self, folder_id, limit=10):
         method_calls = [
-            ["Email/query", {
-                "accountId": self.account_id,
-                "filter": {"inMailbox": folder_id},
-                "sort": [{"property": "receivedAt", "isAscending": False }],
-                "collapseThreads": False, "position": 0, "limit": 20
-            }, "0" ],
-            [ "Email/get", {
-                "accountId": self.account_id,
-                "#ids": {
-                    "name": "Email/query",
-                    "path": "/ids",
-                    "resultOf": "0"
-                },
-                "properties": ['subject', 'from', 'sentAt', 'blobId']
-            }, "1" ],
+            ["Email/query", dict(_EMAIL_QUERY_ARGS, accountId=self.account_id, filter={"inMailbox": folder_id}), "0"],
+            ["Email/get", dict(_EMAIL_GET_ARGS, accountId=self.account_id), "1"],
         ]
         r = self._post_request(method_calls)
-        method_responses = r.json()['methodResponses']
+        method_responses = _json_loads(r.content)['methodResponses']
+        # (subject, from name, sent at, blob id) tuples - the first three are the email list's columns
         return [
-            {'server_id': e['id'], 'subject': e['subject'], 'from': e['from'], 'sent_at': e['sentAt'], 'blob_id': e['blobId']}
+            (e['subject'], e['from'][0]['name'] or '', e['sentAt'], e['blobId'])
             for e in method_responses[1][1]['list']
         ]
 
-    def get_email_obj(self, blob_id):
-        url = self.download_url.replace('{accountId}', self.account_id).replace('{blobId}', blob_id).replace('{name}', 'email').replace('{type}', 'application/octet-stream')
-        r = requests.get(url, headers={'Authorization': self._authorization})
-        if r.ok:
-            return email.message_from_bytes(r.content, _class=email.message.EmailMessage, policy=email_policy.default)
+    def get_email_data(self, blob_id):
+        # the JMAP download URL template uses the same {field} syntax as str.format
+        session_info_cached = self._session_info_cached
+        url = self.download_url.format_map({'accountId': self.account_id, 'blobId': blob_id, 'name': 'email', 'type': 'application/octet-stream'})
+        r = self._session.get(url, timeout=REQUEST_TIMEOUT)
+        if 200 <= r.status_code < 300: # cheaper than r.ok, which calls raise_for_status()
+            return r.content
+        if r.status_code == 401 and session_info_cached:
+            raise SessionExpired() # the download URL comes from the saved session info too
         raise Exception(f'server error downloading email: {r.status_code} -- {r.content.decode("utf8")}')
 
 
+_INSERT_ACCOUNT_SQL = 'INSERT INTO accounts(name, type) VALUES(?, ?)'
+_INSERT_FOLDER_SQL = 'INSERT INTO folders(account_id, server_id, name, role, parent_server_id, sort_order) VALUES(?, ?, ?, ?, ?, ?)'
+_UPSERT_FOLDER_SQL = ('INSERT INTO folders(account_id, server_id, name, role, parent_server_id, sort_order) VALUES(?, ?, ?, ?, ?, ?) '
+                      'ON CONFLICT(server_id) DO UPDATE SET '
+                      'name=excluded.name, role=excluded.role, parent_server_id=excluded.parent_server_id, sort_order=excluded.sort_order')
+_DELETE_FOLDERS_SQL = 'DELETE FROM folders WHERE server_id IN (SELECT value FROM json_each(?))'
+_GET_ACCOUNT_ID_SQL = 'SELECT id FROM accounts'
+_GET_ROOT_FOLDERS_SQL = 'SELECT server_id, name FROM folders WHERE parent_server_id IS NULL ORDER BY sort_order, name'
+_GET_CHILD_FOLDERS_SQL = 'SELECT server_id, name FROM folders WHERE parent_server_id = ? ORDER BY sort_order, name'
+_GET_FOLDER_TREE_SQL = ('WITH RECURSIVE tree(server_id, name, parent_server_id, sort_order, depth) AS ('
+                        'SELECT server_id, name, parent_server_id, sort_order, 0 FROM folders WHERE parent_server_id IS NULL '
+                        'UNION ALL '
+                        'SELECT f.server_id, f.name, f.parent_server_id, f.sort_order, tree.depth + 1 '
+                        'FROM folders f JOIN tree ON f.parent_server_id = tree.server_id'
+                        ') SELECT server_id, name, parent_server_id FROM tree ORDER BY depth, sort_order, name')
+_GET_FOLDER_SQL = 'SELECT server_id, name FROM folders WHERE server_id = ?'
+_GET_EMAIL_DATA_SQL = 'SELECT data FROM email_data WHERE blob_id = ?'
+_SAVE_EMAIL_DATA_SQL = 'INSERT OR REPLACE INTO email_data(blob_id, data) VALUES(?, ?)'
+_INSERT_MISC_SQL = 'INSERT INTO misc(key, value) VALUES(?, ?)'
+_UPDATE_MISC_SQL = 'UPDATE misc SET value = ? WHERE key = ?'
+_REPLACE_MISC_SQL = 'INSERT OR REPLACE INTO misc(key, value) VALUES(?, ?)'
+_SELECT_MISC_SQL = 'SELECT value FROM misc WHERE key = ?'
+_DELETE_MISC_SQL = 'DELETE FROM misc WHERE key = ?'
+
+_UNSET = object()
+
+
 @contextmanager
-def sqlite_txn(cursor):
-    cursor.execute('BEGIN IMMEDIATE')
+def sqlite_txn(conn):
+    # sqlite3 only starts transactions implicitly (and not as IMMEDIATE), so begin explicitly -
+    # commit() & rollback() end it without going through a cursor
+    conn.execute('BEGIN IMMEDIATE')
     try:
         yield
-        cursor.execute('COMMIT')
+        conn.commit()
     except BaseException as e:
-        cursor.execute('ROLLBACK')
+        conn.rollback()
         raise
 
 
 class Storage:
-    DB_INIT_STATEMENTS = [
-        'CREATE TABLE accounts ('
+    SCHEMA_VERSION = 1 # stored in PRAGMA user_version once the tables are created
+    DB_INIT_STATEMENTS = (
+        'CREATE TABLE IF NOT EXISTS accounts ('
             'id INTEGER PRIMARY KEY,'
             'name TEXT NOT NULL UNIQUE,'
             'type TEXT NOT NULL,'
             'CHECK (name != ""),'
             'CHECK (type = "JMAP" OR type = "IMAP" or type = "local")'
             ') STRICT',
-        'CREATE TABLE folders ('
+        'CREATE TABLE IF NOT EXISTS folders ('
             'id INTEGER PRIMARY KEY,'
             'account_id INTEGER NOT NULL,'
             'server_id TEXT NOT NULL UNIQUE,'
@@ -171,104 +256,226 @@ class Storage:
             'FOREIGN KEY(account_id) REFERENCES accounts(id),'
             'FOREIGN KEY(parent_server_id) REFERENCES folders(server_id)'
             ') STRICT',
-        'CREATE TABLE emails ('
+        # covers get_folders(): lookup by parent, already sorted, without reading the table
+        'CREATE INDEX IF NOT EXISTS idx_folders_parent_sort ON folders(parent_server_id, sort_order, name, server_id)',
+        'CREATE TABLE IF NOT EXISTS emails ('
             'id INTEGER PRIMARY KEY,'
             'folder_id INTEGER NOT NULL,'
             'from_header TEXT NOT NULL,'
             'CHECK (from_header != ""),'
             'FOREIGN KEY(folder_id) REFERENCES folders(id)'
             ') STRICT',
-        'CREATE TABLE email_data ('
+        'CREATE INDEX IF NOT EXISTS idx_emails_folder ON emails(folder_id)',
+        'CREATE TABLE IF NOT EXISTS email_data ('
             'id INTEGER PRIMARY KEY,'
-            'email_id INTEGER NOT NULL,'
+            'email_id INTEGER NULL,'
+            'blob_id TEXT NOT NULL UNIQUE,'
             'data BLOB NOT NULL,'
+            'CHECK (blob_id != ""),'
             'FOREIGN KEY(email_id) REFERENCES emails(id)'
             ') STRICT',
-        'CREATE TABLE misc ('
+        'CREATE INDEX IF NOT EXISTS idx_email_data_email ON email_data(email_id)',
+        'CREATE TABLE IF NOT EXISTS misc ('
             'key TEXT UNIQUE NOT NULL,'
             'value TEXT NOT NULL,'
             'CHECK (key != "")'
             'CHECK (value != "")'
             ') STRICT',
-    ]
+    )
+    DB_INIT_SCRIPT = ';\n'.join(DB_INIT_STATEMENTS) + ';\n'
+    # statements that bring a database at user_version N up to N + 1, run before DB_INIT_SCRIPT
+    DB_UPGRADE_STATEMENTS = {
+        # the old email_data table had no blob_id column - it's only a cache of downloaded emails, so it's recreated
+        0: ('DROP TABLE IF EXISTS email_data',),
+    }
+
+    # per-connection settings, sent as one script instead of a statement each
+    DB_CONNECTION_PRAGMAS = (
+        'PRAGMA foreign_keys = ON;'
+        # these only take effect on a new database - they have to come before anything (incl. WAL) writes the file header
+        'PRAGMA page_size = 8192;' # fewer overflow pages for the email BLOBs
+        'PRAGMA auto_vacuum = INCREMENTAL;'
+        'PRAGMA busy_timeout = 30000;' # wait for other writers instead of failing with SQLITE_BUSY
+        'PRAGMA temp_store = MEMORY;'
+        'PRAGMA cache_size = -64000;' # 64 MB, so recently opened emails stay cached
+    )
+    # only for file-backed databases
+    DB_FILE_PRAGMAS = (
+        'PRAGMA mmap_size = 268435456;' # avoids copying pages on reads
+        'PRAGMA journal_size_limit = 67108864;' # truncate the WAL file back to 64 MB after checkpoints
+    )
 
     @staticmethod
     def _get_db_connection(db_name):
-        conn = sqlite3.connect(db_name, isolation_level=None)
-        conn.execute('PRAGMA foreign_keys = ON;')
+        conn = sqlite3.connect(db_name, isolation_level=None, cached_statements=256)
+        conn.executescript(Storage.DB_CONNECTION_PRAGMAS)
+        if db_name != ':memory:':
+            # WAL only needs one fsync per commit
+            journal_mode = conn.execute('PRAGMA journal_mode = WAL;').fetchone()[0]
+            # synchronous=NORMAL is only corruption-safe in WAL mode - keep the default if the VFS refused WAL
+            if journal_mode == 'wal':
+                conn.execute('PRAGMA synchronous = NORMAL;')
+            conn.executescript(Storage.DB_FILE_PRAGMAS)
         return conn
 
-    def _create_tables(self):
-        cursor = self._conn.cursor()
-        with sqlite_txn(cursor):
-            for statement in Storage.DB_INIT_STATEMENTS:
-                cursor.execute(statement)
+    def _create_tables(self, user_version):
+        upgrade_statements = [statement for version in range(user_version, Storage.SCHEMA_VERSION)
+                              for statement in Storage.DB_UPGRADE_STATEMENTS.get(version, ())]
+        # one script & one transaction for the whole schema - executescript() commits any open transaction
+        # before it runs, so the BEGIN/COMMIT have to be part of the script
+        script = ('BEGIN IMMEDIATE;\n' + ''.join(f'{statement};\n' for statement in upgrade_statements) +
+                  Storage.DB_INIT_SCRIPT + f'PRAGMA user_version = {Storage.SCHEMA_VERSION};\nCOMMIT;')
+        try:
+            self._cursor.executescript(script)
+        except BaseException as e:
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            raise
 
     def __init__(self, db_name):
         # creates & initializes database if needed
         self._conn = self._get_db_connection(db_name)
-        tables = self._conn.execute('SELECT name from sqlite_master WHERE type="table"').fetchall()
-        if not tables:
-            self._create_tables()
+        self._cursor = self._conn.cursor() # reused by all the queries, instead of a new cursor each time
+        # user_version is read from the file header, so this is cheaper than looking through sqlite_master
+        user_version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        if user_version < Storage.SCHEMA_VERSION:
+            self._create_tables(user_version)
+        self._folders_state = _UNSET
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # auto_vacuum is INCREMENTAL, so free pages are only given back to the file system here -
+        # the pragma frees one page per step, and execute() only steps it once
+        self._conn.executescript('PRAGMA incremental_vacuum;')
+        # lets SQLite re-analyze any tables whose statistics are out of date
+        self._conn.execute('PRAGMA optimize;')
+        # empties the WAL file - SQLite only does this itself if no other connection has the database open
+        self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        self._conn.close()
+
+    def backup_to(self, path):
+        # copies the whole database, eg. to save an in-memory store to disk
+        dest = sqlite3.connect(path)
+        try:
+            self._conn.backup(dest)
+        finally:
+            dest.close()
 
     @property
     def folders_state(self):
-        result = self._conn.execute("SELECT value FROM misc WHERE key = 'folders-state'").fetchone()
+        if self._folders_state is _UNSET:
+            result = self._cursor.execute(_SELECT_MISC_SQL, ('folders-state',)).fetchone()
+            self._folders_state = result[0] if result else None
+        return self._folders_state
+
+    @property
+    def folders_synced_at(self):
+        # time.time() of the last successful folder sync
+        result = self._cursor.execute(_SELECT_MISC_SQL, ('folders-synced-at',)).fetchone()
         if result:
-            return result[0]
+            return float(result[0])
+
+    def get_session_info(self):
+        result = self._cursor.execute(_SELECT_MISC_SQL, ('jmap-session',)).fetchone()
+        if result:
+            return json.loads(result[0])
+
+    def save_session_info(self, session_info):
+        self._cursor.execute(_REPLACE_MISC_SQL, ('jmap-session', json.dumps(session_info)))
+
+    def delete_session_info(self):
+        self._cursor.execute(_DELETE_MISC_SQL, ('jmap-session',))
 
     def delete_folders(self):
-        cursor = self._conn.cursor()
-        with sqlite_txn(cursor):
-            cursor.execute("DELETE FROM misc WHERE key = 'folders-state'")
+        cursor = self._cursor
+        with sqlite_txn(self._conn):
+            cursor.execute("DELETE FROM misc WHERE key IN ('folders-state', 'folders-synced-at')")
             cursor.execute('DELETE FROM folders')
+        self._folders_state = None
 
     def save_folders(self, folders, state, account_name):
-        cursor = self._conn.cursor()
-        with sqlite_txn(cursor):
-            cursor.execute('INSERT INTO accounts(name, type) VALUES(?, ?)', (account_name, 'JMAP'))
+        cursor = self._cursor
+        with sqlite_txn(self._conn):
+            # the server doesn't send parents before their children, so only check parent_server_id at commit
+            cursor.execute('PRAGMA defer_foreign_keys = ON')
+            cursor.execute(_INSERT_ACCOUNT_SQL, (account_name, 'JMAP'))
             account_id = cursor.lastrowid
-            for f in folders:
-                cursor.execute('INSERT INTO folders(account_id, server_id, name, role, parent_server_id, sort_order) VALUES(?, ?, ?, ?, ?, ?)',
-                               (account_id, f['server_id'], f['name'], f['role'], f['parent_id'], f['sort_order']))
-            cursor.execute('INSERT INTO misc(key, value) VALUES(?, ?)', ('folders-state', state))
+            cursor.executemany(_INSERT_FOLDER_SQL,
+                               ((account_id, f['server_id'], f['name'], f['role'], f['parent_id'], f['sort_order']) for f in folders))
+            cursor.execute(_INSERT_MISC_SQL, ('folders-state', state))
+            cursor.execute(_REPLACE_MISC_SQL, ('folders-synced-at', str(time.time())))
+        self._folders_state = state
+        # give the query planner statistics for the folders we just imported
+        cursor.execute('ANALYZE folders')
 
     def update_folders(self, folder_changes, state):
-        cursor = self._conn.cursor()
-        with sqlite_txn(cursor):
-            for f in folder_changes['created']:
-                print(f'creating folder {f}')
-                cursor.execute('INSERT INTO folders(server_id, name, role, parent_server_id, sort_order) VALUES(?, ?, ?, ?, ?)',
-                               (f['id'], f['name'], f['role'], f['parent_id'], f['sort_order']))
-            for f in folder_changes['updated']:
-                print(f'updating folder {f}')
-                cursor.execute('UPDATE folders SET name=?, role=?, parent_server_id=?, sort_order=? WHERE server_id=?',
-                               (f['name'], f['role'], f['parent_id'], f['sort_order'], f['id']))
-            for f in folder_changes['deleted']:
-                print(f'deleting folder {f}')
-                cursor.execute('DELETE FROM folders WHERE server_id=?', (f['id'],))
-            cursor.execute('UPDATE misc SET value = ? WHERE key = ?', (state, 'folders-state'))
+        created, updated, deleted = folder_changes['created'], folder_changes['updated'], folder_changes['deleted']
+        print(f'creating {len(created)} folders, updating {len(updated)} folders, deleting {len(deleted)} folders')
+        cursor = self._cursor
+        with sqlite_txn(self._conn):
+            cursor.execute('PRAGMA defer_foreign_keys = ON') # created children can come before their parents
+            account_id = cursor.execute(_GET_ACCOUNT_ID_SQL).fetchone()[0]
+            # created & updated folders both go through one upsert statement
+            cursor.executemany(_UPSERT_FOLDER_SQL,
+                               ((account_id, f['id'], f['name'], f['role'], f['parent_id'], f['sort_order']) for f in created + updated))
+            if deleted:
+                cursor.execute(_DELETE_FOLDERS_SQL, (json.dumps([f['id'] for f in deleted]),))
+            cursor.execute(_UPDATE_MISC_SQL, (state, 'folders-state'))
+            cursor.execute(_REPLACE_MISC_SQL, ('folders-synced-at', str(time.time())))
+        self._folders_state = state
 
     def get_folders(self, parent_id=None):
-        fields = 'server_id, name'
-        folders = []
+        # rows are streamed from their own cursor, so other queries can run while the caller iterates
         if parent_id:
-            results = self._conn.execute(f'SELECT {fields} FROM folders WHERE parent_server_id = ? ORDER BY sort_order,name', (parent_id,)).fetchall()
+            yield from self._conn.execute(_GET_CHILD_FOLDERS_SQL, (parent_id,))
         else:
-            results = self._conn.execute(f'SELECT {fields} FROM folders WHERE parent_server_id IS NULL ORDER BY sort_order,name').fetchall()
-        folders.extend([{'server_id': r[0], 'name': r[1]} for r in results])
-        return folders
+            yield from self._conn.execute(_GET_ROOT_FOLDERS_SQL)
+
+    def get_folder_tree(self):
+        # all folders in one query, ordered by depth so parents come before their children
+        return self._cursor.execute(_GET_FOLDER_TREE_SQL).fetchall()
 
     def get_folder(self, folder_id):
-        fields = 'server_id, name'
-        folder = self._conn.execute(f'SELECT {fields} FROM folders WHERE server_id = ?', (folder_id,)).fetchone()
-        return {'id': folder[0], 'name': folder[1]}
+        return self._cursor.execute(_GET_FOLDER_SQL, (folder_id,)).fetchone()
+
+    def get_email_data(self, blob_id):
+        result = self._cursor.execute(_GET_EMAIL_DATA_SQL, (blob_id,)).fetchone()
+        if result:
+            return result[0]
+
+    def save_email_data(self, blob_id, data):
+        self._cursor.execute(_SAVE_EMAIL_DATA_SQL, (blob_id, data))
+
+
+def call_when_done(widget, future, callback):
+    # tkinter isn't thread-safe, so poll from the Tk event loop instead of calling back from the worker thread
+    if future.done():
+        callback(future)
+    else:
+        widget.after(50, call_when_done, widget, future, callback)
+
+
+def refresh_session_in_background(widget, executor, server, callback):
+    # after a SessionExpired error - the request to the server runs on the executor, so the GUI doesn't freeze,
+    # and the new session info is saved from the Tk thread before calling callback()
+    def session_info_fetched(future):
+        server.set_session_info(future.result())
+        callback()
+    call_when_done(widget, executor.submit(server.fetch_session_info), session_info_fetched)
 
 
 class EmailDisplay:
 
-    def __init__(self, master, row, column, server):
+    def __init__(self, master, row, column, storage, server, executor):
+        self.storage = storage
         self.server = server
+        self.executor = executor
+        self._email_future = None
 
         self.frame = ttk.Frame(master=master)
         self.frame.columnconfigure(0, weight=1)
@@ -282,9 +489,38 @@ class EmailDisplay:
         self.frame.grid(row=row, column=column, sticky=(tk.N, tk.W, tk.S, tk.E))
 
     def display_email(self, blob_id):
+        # blobs never change, so only download a message the first time it's opened
+        if self._email_future:
+            self._email_future.cancel() # no-op if the download has already started
+        email_data = self.storage.get_email_data(blob_id)
+        if email_data is None:
+            self._email_future = self.executor.submit(self.server.get_email_data, blob_id)
+            call_when_done(self.frame, self._email_future, lambda f: self._email_downloaded(f, blob_id))
+        else:
+            self._email_future = None
+            self._show_email(email_data)
+
+    def _email_downloaded(self, future, blob_id):
+        if future.cancelled():
+            return
+        try:
+            email_data = future.result()
+        except SessionExpired:
+            if future is self._email_future:
+                refresh_session_in_background(self.frame, self.executor, self.server, lambda: self._session_refreshed(future, blob_id))
+            return
+        self.storage.save_email_data(blob_id, email_data)
+        if future is self._email_future: # ignore the result if another email was selected in the meantime
+            self._show_email(email_data)
+
+    def _session_refreshed(self, future, blob_id):
+        if future is self._email_future: # another email may have been selected while the session was refreshed
+            self.display_email(blob_id)
+
+    def _show_email(self, email_data):
         if self.label:
             self.label.destroy()
-        email_obj = self.server.get_email_obj(blob_id)
+        email_obj = email.message_from_bytes(email_data, _class=email.message.EmailMessage, policy=email_policy.default)
         self.text_widget = ScrolledText(master=self.frame)
         self.text_widget.insert(tk.END, email_obj.get_body())
         self.text_widget.grid(row=0, column=0, sticky=(tk.N, tk.W, tk.S, tk.E))
@@ -300,10 +536,11 @@ class EmailDisplay:
 
 class EmailsListDisplay:
 
-    def __init__(self, master, row, column, storage, server, display_email):
-        self.storage = storage
+    def __init__(self, master, row, column, server, executor, display_email):
         self.server = server
+        self.executor = executor
         self.display_email = display_email
+        self._emails_future = None
 
         self.frame = ttk.Frame(master=master)
         self.frame.columnconfigure(0, weight=1)
@@ -316,6 +553,30 @@ class EmailsListDisplay:
         self.display_emails()
 
     def display_emails(self, folder_id=None):
+        if self._emails_future:
+            self._emails_future.cancel() # no-op if the request has already started
+        if folder_id: # the folders tree uses the server ids as item ids, so no need to look the folder up
+            self._emails_future = self.executor.submit(self.server.get_emails, folder_id=folder_id)
+            call_when_done(self.frame, self._emails_future, lambda f: self._emails_fetched(f, folder_id))
+        else:
+            self._emails_future = None
+            self._show_emails(None)
+
+    def _emails_fetched(self, future, folder_id):
+        if future is not self._emails_future: # ignore the result if another folder was selected in the meantime
+            return
+        try:
+            emails = future.result()
+        except SessionExpired:
+            refresh_session_in_background(self.frame, self.executor, self.server, lambda: self._session_refreshed(future, folder_id))
+            return
+        self._show_emails(emails)
+
+    def _session_refreshed(self, future, folder_id):
+        if future is self._emails_future: # another folder may have been selected while the session was refreshed
+            self.display_emails(folder_id)
+
+    def _show_emails(self, emails):
         if self.emails_frame:
             self.emails_frame.destroy()
 
@@ -323,10 +584,8 @@ class EmailsListDisplay:
         self.emails_frame.columnconfigure(0, weight=1)
         self.emails_frame.rowconfigure(0, weight=1)
 
-        if folder_id:
-            folder_info = self.storage.get_folder(folder_id)
-
-            self.emails = self.server.get_emails(folder_id=folder_info['id'])
+        if emails is not None:
+            self.emails = emails
 
             columns = ('subject', 'from', 'sent_at')
             self.emails_tree = ttk.Treeview(master=self.emails_frame, columns=columns, show='headings')
@@ -334,9 +593,10 @@ class EmailsListDisplay:
             self.emails_tree.heading('from', text='From')
             self.emails_tree.heading('sent_at', text='Date')
 
-            for index, email in enumerate(self.emails):
-                values = (email['subject'], email['from'][0]['name'] or '', email['sent_at'])
-                self.emails_tree.insert(parent='', index=tk.END, iid=index, values=values)
+            # the tree isn't gridded yet, so Tk only lays it out once after all the rows are in
+            insert = self.emails_tree.insert
+            for index, (subject, from_name, sent_at, blob_id) in enumerate(self.emails):
+                insert(parent='', index=tk.END, iid=index, values=(subject, from_name, sent_at))
 
             self.emails_tree.bind('<Button-1>', self._email_selected)
 
@@ -348,8 +608,7 @@ class EmailsListDisplay:
 
     def _email_selected(self, event):
         email_index = self.emails_tree.identify_row(event.y)
-        email_info = self.emails[int(email_index)]
-        blob_id = email_info['blob_id']
+        blob_id = self.emails[int(email_index)][3]
 
         self.display_email(blob_id=blob_id)
 
@@ -365,14 +624,12 @@ class AccountsDisplay:
         self.frame.columnconfigure(0, weight=1)
         self.frame.rowconfigure(0, weight=1)
 
-        columns = ('name')
-        self.folders_tree = ttk.Treeview(master=self.frame, columns=columns, show='headings')
-        self.folders_tree.heading('name', text='Folders')
+        self.folders_tree = ttk.Treeview(master=self.frame, show=('tree', 'headings'))
+        self.folders_tree.heading('#0', text='Folders')
 
-        folders = self.storage.get_folders()
-        for f in folders:
-            values = (f['name'],)
-            self.folders_tree.insert(parent='', index=tk.END, iid=f['server_id'], values=values)
+        # parents come before their children, so each folder can be inserted under its parent
+        for server_id, name, parent_server_id in self.storage.get_folder_tree():
+            self.folders_tree.insert(parent=parent_server_id or '', index=tk.END, iid=server_id, text=name)
 
         self.folders_tree.bind('<Button-1>', self._folder_selected)
         self.folders_tree.grid(row=0, column=0, sticky=(tk.N, tk.W, tk.S, tk.E))
@@ -393,6 +650,9 @@ class GUI:
         self.root = tk.Tk()
         self.root.title('Email Client')
 
+        # network requests run in the background so they don't freeze the GUI
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
         w, h = self.root.winfo_screenwidth(), self.root.winfo_screenheight()
         self.root.geometry("%dx%d+0+0" % (w, h))
 
@@ -408,31 +668,44 @@ class GUI:
         self.content_frame.rowconfigure(0, weight=1)
         self.content_frame.grid(row=0, column=0, sticky=(tk.N, tk.W, tk.S, tk.E))
 
-        self.email_display = EmailDisplay(master=self.content_frame, row=0, column=2, server=self.server)
+        self.email_display = EmailDisplay(master=self.content_frame, row=0, column=2, storage=self.storage,
+                                          server=self.server, executor=self.executor)
 
-        self.folder_display = EmailsListDisplay(master=self.content_frame, row=0, column=1, storage=self.storage,
-                                            server=self.server, display_email=self.email_display.display_email)
+        self.folder_display = EmailsListDisplay(master=self.content_frame, row=0, column=1,
+                                            server=self.server, executor=self.executor,
+                                            display_email=self.email_display.display_email)
 
         self.accounts_display = AccountsDisplay(master=self.content_frame, row=0, column=0, storage=self.storage,
                                                 display_emails=self.folder_display.display_emails)
 
 
 if __name__ == '__main__':
-    import requests
-
     email_file = os.environ['EMAIL_FILE']
 
-    storage = Storage(email_file)
-    server = EmailServer()
-
-    if not storage.folders_state:
-        print(f'Fetching folders for the first time...')
-        state, folders = server.get_folders()
-        storage.save_folders(folders, state, server.account_id)
-    else:
-        print(f'Checking for folder updates...')
-        state, folder_changes = server.get_folder_changes(storage.folders_state)
-        storage.update_folders(folder_changes, state)
-
-    app = GUI(storage, server)
-    app.root.mainloop()
+    with Storage(email_file) as storage:
+        server = EmailServer(storage)
+
+        if not storage.folders_state:
+            print(f'Fetching folders for the first time...')
+            try:
+                state, folders = server.get_folders()
+            except SessionExpired:
+                server.refresh_session()
+                state, folders = server.get_folders()
+            storage.save_folders(folders, state, server.account_id)
+        elif time.time() - (storage.folders_synced_at or 0) < FOLDERS_SYNC_INTERVAL:
+            print(f'Folders were checked for updates recently - skipping')
+        else:
+            print(f'Checking for folder updates...')
+            try:
+                state, folder_changes = server.get_folder_changes(storage.folders_state)
+            except SessionExpired:
+                server.refresh_session()
+                state, folder_changes = server.get_folder_changes(storage.folders_state)
+            storage.update_folders(folder_changes, state)
+
+        app = GUI(storage, server)
+        app.root.mainloop()
+
+        app.executor.shutdown(wait=False)
+        server.close()
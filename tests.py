@@ -1,12 +1,319 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import time
+import types
 import unittest
+from unittest import mock
 
 import email_client
 
 
+FOLDERS = [
+    {'server_id': 'inbox', 'name': 'Inbox', 'role': 'inbox', 'parent_id': None, 'sort_order': 1},
+    {'server_id': 'archive', 'name': 'Archive', 'role': 'archive', 'parent_id': None, 'sort_order': 2},
+    {'server_id': 'sub', 'name': 'Sub', 'role': None, 'parent_id': 'archive', 'sort_order': 0},
+]
+
+
 class StorageTests(unittest.TestCase):
     def test(self):
         storage = email_client.Storage(':memory:')
 
+    def test_file_db(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = email_client.Storage(os.path.join(tmp, 'email.db'))
+            self.assertEqual(storage._conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(storage._conn.execute('PRAGMA synchronous').fetchone()[0], 1) # normal
+            self.assertEqual(storage._conn.execute('PRAGMA auto_vacuum').fetchone()[0], 2) # incremental
+            self.assertEqual(storage._conn.execute('PRAGMA page_size').fetchone()[0], 8192)
+            storage.save_folders(FOLDERS, 'state1', 'account')
+            self.assertEqual(storage.folders_state, 'state1')
+            self.assertEqual(storage._conn.execute('PRAGMA user_version').fetchone()[0], email_client.Storage.SCHEMA_VERSION)
+            # databases created before the schema version was recorded are upgraded without errors
+            storage._conn.execute('PRAGMA user_version = 0')
+            storage.close()
+
+            # close() checkpoints everything into the database file
+            wal_path = os.path.join(tmp, 'email.db-wal')
+            self.assertFalse(os.path.exists(wal_path) and os.path.getsize(wal_path))
+
+            with email_client.Storage(os.path.join(tmp, 'email.db')) as storage:
+                self.assertEqual(storage.folders_state, 'state1')
+                self.assertEqual(storage._conn.execute('PRAGMA user_version').fetchone()[0], email_client.Storage.SCHEMA_VERSION)
+
+    def test_close_frees_pages(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with email_client.Storage(os.path.join(tmp, 'email.db')) as storage:
+                storage.save_email_data('blob1', b'x' * 1000000)
+                storage._conn.execute('DELETE FROM email_data')
+                self.assertGreater(storage._conn.execute('PRAGMA freelist_count').fetchone()[0], 0)
+            with email_client.Storage(os.path.join(tmp, 'email.db')) as storage:
+                self.assertEqual(storage._conn.execute('PRAGMA freelist_count').fetchone()[0], 0)
+
+    def test_upgrade_old_db(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # the email tables as they were created before the schema version was recorded
+            conn = email_client.sqlite3.connect(os.path.join(tmp, 'email.db'))
+            conn.executescript(
+                'CREATE TABLE emails (id INTEGER PRIMARY KEY, folder_id INTEGER NOT NULL, from_header TEXT NOT NULL,'
+                ' CHECK (from_header != ""), FOREIGN KEY(folder_id) REFERENCES folders(id)) STRICT;'
+                'CREATE TABLE email_data (id INTEGER PRIMARY KEY, email_id INTEGER NOT NULL, data BLOB NOT NULL,'
+                ' FOREIGN KEY(email_id) REFERENCES emails(id)) STRICT;'
+            )
+            conn.close()
+
+            with email_client.Storage(os.path.join(tmp, 'email.db')) as storage:
+                self.assertEqual(storage._conn.execute('PRAGMA user_version').fetchone()[0], email_client.Storage.SCHEMA_VERSION)
+                storage.save_email_data('blob1', b'hello')
+                self.assertEqual(storage.get_email_data('blob1'), b'hello')
+
+    def test_upgrade_keeps_email_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with email_client.Storage(os.path.join(tmp, 'email.db')) as storage:
+                storage.save_email_data('blob1', b'hello')
+            # only databases from before the schema version was recorded lose their email_data table
+            with mock.patch.object(email_client.Storage, 'SCHEMA_VERSION', email_client.Storage.SCHEMA_VERSION + 1):
+                with email_client.Storage(os.path.join(tmp, 'email.db')) as storage:
+                    self.assertEqual(storage._conn.execute('PRAGMA user_version').fetchone()[0], email_client.Storage.SCHEMA_VERSION)
+                    self.assertEqual(storage.get_email_data('blob1'), b'hello')
+
+    def test_backup_to(self):
+        storage = email_client.Storage(':memory:')
+        storage.save_folders(FOLDERS, 'state1', 'account')
+        with tempfile.TemporaryDirectory() as tmp:
+            storage.backup_to(os.path.join(tmp, 'backup.db'))
+            backup = email_client.Storage(os.path.join(tmp, 'backup.db'))
+            self.assertEqual(backup.folders_state, 'state1')
+            self.assertEqual(list(backup.get_folders()), [('inbox', 'Inbox'), ('archive', 'Archive')])
+            backup.close()
+
+    def test_save_folders(self):
+        storage = email_client.Storage(':memory:')
+        storage.save_folders(FOLDERS, 'state1', 'account')
+        self.assertEqual(storage.folders_state, 'state1')
+        self.assertAlmostEqual(storage.folders_synced_at, time.time(), delta=60)
+        self.assertEqual(list(storage.get_folders()), [('inbox', 'Inbox'), ('archive', 'Archive')])
+        self.assertEqual(list(storage.get_folders(parent_id='archive')), [('sub', 'Sub')])
+        self.assertEqual(storage.get_folder('sub'), ('sub', 'Sub'))
+
+    def test_get_folder_tree(self):
+        storage = email_client.Storage(':memory:')
+        storage.save_folders(FOLDERS + [{'server_id': 'subsub', 'name': 'A', 'role': None, 'parent_id': 'sub', 'sort_order': 0}],
+                             'state1', 'account')
+        self.assertEqual(storage.get_folder_tree(), [
+            ('inbox', 'Inbox', None),
+            ('archive', 'Archive', None),
+            ('sub', 'Sub', 'archive'),
+            ('subsub', 'A', 'sub'),
+        ])
+
+    def test_save_folders_rollback(self):
+        storage = email_client.Storage(':memory:')
+        with self.assertRaises(email_client.sqlite3.IntegrityError):
+            storage.save_folders(FOLDERS + FOLDERS[:1], 'state1', 'account')
+        self.assertIsNone(storage.folders_state)
+        self.assertEqual(storage._conn.execute('SELECT COUNT(*) FROM accounts').fetchone()[0], 0)
+        storage.save_folders(FOLDERS, 'state1', 'account')
+        self.assertEqual(storage.folders_state, 'state1')
+
+    def test_queries_use_indexes(self):
+        storage = email_client.Storage(':memory:')
+        for sql, params in [(email_client._GET_ROOT_FOLDERS_SQL, ()), (email_client._GET_CHILD_FOLDERS_SQL, ('inbox',))]:
+            plan = ' '.join(r[3] for r in storage._conn.execute(f'EXPLAIN QUERY PLAN {sql}', params))
+            self.assertIn('COVERING INDEX idx_folders_parent_sort', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+        # misc.key is UNIQUE, so SQLite's automatic index already serves lookups by key
+        plan = ' '.join(r[3] for r in storage._conn.execute(f'EXPLAIN QUERY PLAN {email_client._SELECT_MISC_SQL}', ('folders-state',)))
+        self.assertIn('INDEX sqlite_autoindex_misc_1', plan)
+
+    def test_update_folders(self):
+        storage = email_client.Storage(':memory:')
+        storage.save_folders(FOLDERS, 'state1', 'account')
+        changes = {
+            'created': [{'id': 'new', 'name': 'New', 'role': None, 'parent_id': 'inbox', 'sort_order': 0}],
+            'updated': [{'id': 'archive', 'name': 'Old', 'role': 'archive', 'parent_id': None, 'sort_order': 0}],
+            'deleted': [{'id': 'sub'}],
+        }
+        storage.update_folders(changes, 'state2')
+        self.assertEqual(storage.folders_state, 'state2')
+        self.assertEqual(list(storage.get_folders()), [('archive', 'Old'), ('inbox', 'Inbox')])
+        self.assertEqual(list(storage.get_folders(parent_id='archive')), [])
+        self.assertEqual(list(storage.get_folders(parent_id='inbox')), [('new', 'New')])
+
+    def test_children_before_parents(self):
+        storage = email_client.Storage(':memory:')
+        storage.save_folders(FOLDERS[::-1], 'state1', 'account')
+        self.assertEqual(list(storage.get_folders(parent_id='archive')), [('sub', 'Sub')])
+        changes = {
+            'created': [{'id': 'c', 'name': 'C', 'role': None, 'parent_id': 'p', 'sort_order': 0},
+                        {'id': 'p', 'name': 'P', 'role': None, 'parent_id': None, 'sort_order': 0}],
+            'updated': [],
+            'deleted': [],
+        }
+        storage.update_folders(changes, 'state2')
+        self.assertEqual(list(storage.get_folders(parent_id='p')), [('c', 'C')])
+        # a missing parent is still caught, at commit
+        changes['created'] = [{'id': 'd', 'name': 'D', 'role': None, 'parent_id': 'missing', 'sort_order': 0}]
+        with self.assertRaises(email_client.sqlite3.IntegrityError):
+            storage.update_folders(changes, 'state3')
+        self.assertEqual(storage.folders_state, 'state2')
+        self.assertIsNone(storage.get_folder('d'))
+
+    def test_email_data(self):
+        storage = email_client.Storage(':memory:')
+        self.assertIsNone(storage.get_email_data('blob1'))
+        storage.save_email_data('blob1', b'From: a@example.com\r\n\r\nhello')
+        self.assertEqual(storage.get_email_data('blob1'), b'From: a@example.com\r\n\r\nhello')
+        storage.save_email_data('blob1', b'new')
+        self.assertEqual(storage.get_email_data('blob1'), b'new')
+
+    def test_delete_folders(self):
+        storage = email_client.Storage(':memory:')
+        self.assertIsNone(storage.folders_state)
+        storage.save_folders(FOLDERS, 'state1', 'account')
+        self.assertEqual(storage.folders_state, 'state1')
+        storage.delete_folders()
+        self.assertIsNone(storage.folders_state)
+        self.assertIsNone(storage.folders_synced_at)
+        self.assertEqual(list(storage.get_folders()), [])
+
+    def test_session_info(self):
+        storage = email_client.Storage(':memory:')
+        self.assertIsNone(storage.get_session_info())
+        info = {'account_id': 'a1', 'api_url': 'https://localhost/jmap/', 'download_url': 'https://localhost/download/'}
+        storage.save_session_info(info)
+        self.assertEqual(storage.get_session_info(), info)
+        storage.save_session_info(dict(info, account_id='a2'))
+        self.assertEqual(storage.get_session_info()['account_id'], 'a2')
+        storage.delete_session_info()
+        self.assertIsNone(storage.get_session_info())
+
+
+SESSION_INFO = {'account_id': 'a1', 'api_url': 'https://localhost/jmap/',
+                'download_url': 'https://localhost/download/{accountId}/{blobId}/{name}?type={type}'}
+SESSION = {
+    'primaryAccounts': {'urn:ietf:params:jmap:mail': 'a2'},
+    'apiUrl': 'https://localhost/jmap/api/',
+    'downloadUrl': 'https://localhost/jmap/download/{accountId}/{blobId}/{name}?type={type}',
+}
+EMAILS = {'methodResponses': [
+    ['Email/query', {'ids': ['e1']}, '0'],
+    ['Email/get', {'list': [{'subject': 'Hi', 'from': [{'name': 'Bob', 'email': 'bob@localhost'}],
+                             'sentAt': '2024-01-01T00:00:00Z', 'blobId': 'blob1'}]}, '1'],
+]}
+
+
+class EmailServerTests(unittest.TestCase):
+    # requests isn't installed in CI, so the server talks to a stand-in module that replies with queued responses
+
+    def setUp(self):
+        self.responses = [] # (status code, body) pairs
+        self.sent = [] # (method, url, parsed JSON body) tuples
+        tests = self
+
+        class Session:
+            def __init__(self):
+                self.headers = {}
+            def mount(self, prefix, adapter):
+                pass
+            def close(self):
+                pass
+            def get(self, url, timeout):
+                tests.assertEqual(timeout, email_client.REQUEST_TIMEOUT)
+                return self.request('GET', url, None)
+            def post(self, url, data, headers, timeout):
+                tests.assertEqual(timeout, email_client.REQUEST_TIMEOUT)
+                return self.request('POST', url, json.loads(data))
+            def request(self, method, url, body):
+                tests.sent.append((method, url, body))
+                status_code, content = tests.responses.pop(0)
+                if not isinstance(content, bytes):
+                    content = json.dumps(content).encode('utf8')
+                return types.SimpleNamespace(status_code=status_code, content=content)
+
+        requests = types.ModuleType('requests')
+        requests.Session = Session
+        requests.adapters = types.SimpleNamespace(HTTPAdapter=lambda **kwargs: None)
+        for patcher in [mock.patch.dict(sys.modules, {'requests': requests}),
+                        mock.patch.dict(os.environ, {'TOKEN': 'token', 'SESSION_URL': 'https://localhost/jmap/session'})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_stale_session_on_worker_thread(self):
+        storage = email_client.Storage(':memory:')
+        storage.save_session_info(SESSION_INFO)
+        server = email_client.EmailServer(storage)
+        self.assertEqual(self.sent, [])
+        self.responses = [(401, b'unauthorized'), (200, SESSION), (200, EMAILS)]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with self.assertRaises(email_client.SessionExpired):
+                executor.submit(server.get_emails, folder_id='inbox').result()
+            # storage can't be used from the worker, so only the request for the new session info runs there,
+            # and saving it is left to the Tk thread
+            session_info = executor.submit(server.fetch_session_info).result()
+            self.assertEqual(storage.get_session_info(), SESSION_INFO)
+            server.set_session_info(session_info)
+            emails = executor.submit(server.get_emails, folder_id='inbox').result()
+        self.assertEqual(emails, [('Hi', 'Bob', '2024-01-01T00:00:00Z', 'blob1')])
+        self.assertEqual(storage.get_session_info()['account_id'], 'a2')
+        method, url, body = self.sent[-1]
+        self.assertEqual(url, 'https://localhost/jmap/api/')
+        self.assertEqual([args['accountId'] for name, args, call_id in body['methodCalls']], ['a2', 'a2'])
+
+
+    def test_session_info_cache(self):
+        storage = email_client.Storage(':memory:')
+        self.responses = [(200, SESSION)]
+        server = email_client.EmailServer(storage)
+        self.assertEqual(self.sent, [('GET', 'https://localhost/jmap/session', None)])
+        self.assertEqual((server.account_id, server.api_url), ('a2', 'https://localhost/jmap/api/'))
+        self.assertEqual(storage.get_session_info()['account_id'], 'a2')
+        # the next start uses the saved session info without asking the server
+        server = email_client.EmailServer(storage)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual((server.account_id, server.api_url), ('a2', 'https://localhost/jmap/api/'))
+
+    def test_stale_session_download(self):
+        storage = email_client.Storage(':memory:')
+        storage.save_session_info(SESSION_INFO)
+        server = email_client.EmailServer(storage)
+        self.responses = [(401, b'unauthorized'), (200, SESSION), (200, b'hello')]
+        with self.assertRaises(email_client.SessionExpired):
+            server.get_email_data('blob1')
+        server.refresh_session()
+        self.assertEqual(server.get_email_data('blob1'), b'hello')
+        self.assertEqual(self.sent[-1][1], 'https://localhost/jmap/download/a2/blob1/email?type=application/octet-stream')
+        # once the session info is fresh, a 401 is a real error
+        self.responses = [(401, b'unauthorized')]
+        with self.assertRaises(Exception) as cm:
+            server.get_email_data('blob1')
+        self.assertNotIsInstance(cm.exception, email_client.SessionExpired)
+
+    def test_get_folder_changes(self):
+        storage = email_client.Storage(':memory:')
+        storage.save_session_info(SESSION_INFO)
+        server = email_client.EmailServer(storage)
+        changes = {'newState': 'state2', 'created': [], 'updated': [], 'destroyed': ['sub'], 'updatedProperties': None}
+        self.responses = [(200, {'methodResponses': [['Mailbox/changes', changes, '0']]})]
+        self.assertEqual(server.get_folder_changes('state1'),
+                         ('state2', {'created': [], 'deleted': [{'id': 'sub'}], 'updated': []}))
+        # nothing created or updated, so the folder details aren't requested
+        self.assertEqual(len(self.sent), 1)
+
+        changes = dict(changes, created=['new'], destroyed=[])
+        new_folder = {'id': 'new', 'name': 'New', 'role': None, 'parentId': None, 'sortOrder': 0}
+        self.responses = [
+            (200, {'methodResponses': [['Mailbox/changes', changes, '0']]}),
+            (200, {'methodResponses': [['Mailbox/get', {'list': [new_folder]}, '0'], ['Mailbox/get', {'list': []}, '1']]}),
+        ]
+        state, folder_changes = server.get_folder_changes('state1')
+        self.assertEqual(folder_changes['created'], [{'id': 'new', 'name': 'New', 'role': None, 'parent_id': None, 'sort_order': 0}])
+        self.assertEqual(folder_changes['updated'], [])
+        self.assertEqual([call[0] for call in self.sent[-1][2]['methodCalls']], ['Mailbox/get', 'Mailbox/get'])
+
 
 if __name__ == '__main__':
     unittest.main()